@@ -16,7 +16,6 @@
 import argparse
 import time
 import re
-import svgwrite
 import os
 from edgetpu.classification.engine import ClassificationEngine
 import common
@@ -29,11 +28,11 @@ def load_labels(path):
        return {int(num): text.strip() for num, text in lines}
 
 def generate_svg(size, text_lines):
-    dwg = svgwrite.Drawing('', size=size)
+    svg = gstreamer.SvgBuilder(size)
     for y, line in enumerate(text_lines, start=1):
-      dwg.add(dwg.text(line, insert=(11, y*20+1), fill='black', font_size='20'))
-      dwg.add(dwg.text(line, insert=(10, y*20), fill='white', font_size='20'))
-    return dwg.tostring()
+      svg.add_text(11, y*20+1, line, 'black', font_size=20)
+      svg.add_text(10, y*20, line, 'white', font_size=20)
+    return svg.finish()
 
 def main():
     default_model_dir = "../all_models"
@@ -63,7 +62,7 @@ def main():
     def user_callback(input_tensor, src_size, inference_box):
       nonlocal fps_counter
       start_time = time.monotonic()
-      results = engine.classify_with_input_tensor(input_tensor,
+      results = engine.classify_with_input_tensor(input_tensor.reshape(-1),
           threshold=args.threshold, top_k=args.top_k)
       end_time = time.monotonic()
       text_lines = [
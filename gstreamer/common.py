@@ -14,7 +14,6 @@
 
 """Common utilities."""
 import collections
-import svgwrite
 import time
 
 def avg_fps_counter(window_size):
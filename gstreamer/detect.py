@@ -28,7 +28,6 @@ python3 detect.py \
 import argparse
 import time
 import re
-import svgwrite
 import os
 from edgetpu.detection.engine import DetectionEngine
 import common
@@ -40,19 +39,19 @@ def load_labels(path):
        lines = (p.match(line).groups() for line in f.readlines())
        return {int(num): text.strip() for num, text in lines}
 
-def shadow_text(dwg, x, y, text, font_size=20):
-    dwg.add(dwg.text(text, insert=(x+1, y+1), fill='black', font_size=font_size))
-    dwg.add(dwg.text(text, insert=(x, y), fill='white', font_size=font_size))
+def shadow_text(svg, x, y, text, font_size=20):
+    svg.add_text(x+1, y+1, text, 'black', font_size=font_size)
+    svg.add_text(x, y, text, 'white', font_size=font_size)
 
 def generate_svg(src_size, inference_size, inference_box, objs, labels, text_lines):
-    dwg = svgwrite.Drawing('', size=src_size)
+    svg = gstreamer.SvgBuilder(src_size)
     src_w, src_h = src_size
     inf_w, inf_h = inference_size
     box_x, box_y, box_w, box_h = inference_box
     scale_x, scale_y = src_w / box_w, src_h / box_h
 
     for y, line in enumerate(text_lines, start=1):
-        shadow_text(dwg, 10, y*20, line)
+        shadow_text(svg, 10, y*20, line)
     for obj in objs:
         x0, y0, x1, y1 = obj.bounding_box.flatten().tolist()
         # Relative coordinates.
@@ -65,10 +64,9 @@ def generate_svg(src_size, inference_size, inference_box, objs, labels, text_lin
         x, y, w, h = x * scale_x, y * scale_y, w * scale_x, h * scale_y
         percent = int(100 * obj.score)
         label = '%d%% %s' % (percent, labels[obj.label_id])
-        shadow_text(dwg, x, y - 5, label)
-        dwg.add(dwg.rect(insert=(x,y), size=(w, h),
-                        fill='none', stroke='red', stroke_width='2'))
-    return dwg.tostring()
+        shadow_text(svg, x, y - 5, label)
+        svg.add_rect(x, y, w, h, 'red', stroke_width=2)
+    return svg.finish()
 
 def main():
     default_model_dir = '../all_models'
@@ -98,7 +96,7 @@ def main():
     def user_callback(input_tensor, src_size, inference_box):
       nonlocal fps_counter
       start_time = time.monotonic()
-      objs = engine.detect_with_input_tensor(input_tensor,
+      objs = engine.detect_with_input_tensor(input_tensor.reshape(-1),
                                     threshold=args.threshold,
                                     top_k=args.top_k)
       end_time = time.monotonic()
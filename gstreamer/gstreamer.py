@@ -12,34 +12,170 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import ctypes
+import functools
+import numpy as np
+import os
 import sys
-import svgwrite
 import threading
+from xml.sax.saxutils import escape, quoteattr
 
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
 gi.require_version('GstBase', '1.0')
+gi.require_version('GstVideo', '1.0')
 gi.require_version('Gtk', '3.0')
-from gi.repository import GLib, GObject, Gst, GstBase, Gtk
+from gi.repository import GLib, GObject, Gst, GstApp, GstBase, GstVideo, Gtk
 
 GObject.threads_init()
 Gst.init(None)
 
+# For default camera (Coral Camera w/ Dev Board):
+SRC_ELEMENT = 'v4l2src device=/dev/video0'
+# For alternative camera (USB camera w/ Dev Board):
+#SRC_ELEMENT = 'v4l2src device=/dev/video1'
+SRC_CAPS = 'video/x-raw,width={width},height={height},framerate=30/1'
+SINK_ELEMENT = 'appsink name=appsink'
+SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
+LEAKY_Q = 'queue max-size-buffers=1 leaky=downstream'
+# How long to wait for more frames to fill a batch.
+BATCH_TIMEOUT = Gst.SECOND // 100
+
+# Only the caps are left to be filled in per run.
+PIPELINE_CORAL = SRC_ELEMENT + """ ! {src_caps} ! glupload ! tee name=t
+    t. ! queue ! glfilterbin filter=glbox name=glbox ! {sink_caps} ! """ + SINK_ELEMENT + """
+    t. ! queue ! glsvgoverlaysink name=overlaysink
+"""
+PIPELINE_DESKTOP = SRC_ELEMENT + """ ! {src_caps} ! tee name=t
+    t. ! """ + LEAKY_Q + """ ! videoscale ! {scale_caps} ! videoconvert
+       ! videobox name=box autocrop=true ! {sink_caps} ! """ + SINK_ELEMENT + """
+    t. ! """ + LEAKY_Q + """ ! videoconvert
+       ! rsvgoverlay name=overlay ! videoconvert ! ximagesink sync=false
+"""
+
+# Gst.Buffer.map() in the Python bindings copies the mapped memory, so map
+# buffers through libgstreamer directly to get at the underlying pointer.
+_libgst = ctypes.CDLL('libgstreamer-1.0.so.0')
+
+class _GstMapInfo(ctypes.Structure):
+    _fields_ = [('memory', ctypes.c_void_p),  # GstMemory *memory
+                ('flags', ctypes.c_int),  # GstMapFlags flags
+                ('data', ctypes.POINTER(ctypes.c_uint8)),  # guint8 *data
+                ('size', ctypes.c_size_t),  # gsize size
+                ('maxsize', ctypes.c_size_t),  # gsize maxsize
+                ('user_data', ctypes.c_void_p * 4),  # gpointer user_data[4]
+                ('_gst_reserved', ctypes.c_void_p * 4)]  # GST_PADDING
+
+_libgst.gst_buffer_map.argtypes = [ctypes.c_void_p, ctypes.POINTER(_GstMapInfo), ctypes.c_int]
+_libgst.gst_buffer_map.restype = ctypes.c_int
+_libgst.gst_buffer_unmap.argtypes = [ctypes.c_void_p, ctypes.POINTER(_GstMapInfo)]
+_libgst.gst_buffer_unmap.restype = None
+
+GST_MAP_READ = 1
+
+@contextlib.contextmanager
+def gst_buffer_map_np(gstbuffer, size):
+    """Maps an RGB Gst.Buffer of the given (width, height) as a numpy array.
+
+    The read-only array shares memory with the buffer and is only valid
+    inside the with block. Row padding described by the buffer's GstVideoMeta
+    is kept as array strides, so the array isn't necessarily contiguous.
+    """
+    width, height = size
+    meta = GstVideo.buffer_get_video_meta(gstbuffer)
+    if meta:
+        offset, stride = meta.offset[0], meta.stride[0]
+    else:
+        # Default GStreamer layout, rows are padded to 4 bytes.
+        offset, stride = 0, (width * 3 + 3) & ~3
+
+    # hash() of a boxed PyGObject wrapper is the address of the C struct.
+    ptr = hash(gstbuffer)
+    mapinfo = _GstMapInfo()
+    if not _libgst.gst_buffer_map(ptr, mapinfo, GST_MAP_READ):
+        raise RuntimeError('Couldn\'t map buffer')
+    try:
+        data = (ctypes.c_uint8 * mapinfo.size).from_address(
+            ctypes.addressof(mapinfo.data.contents))
+        frame = np.ndarray((height, width, 3), dtype=np.uint8, buffer=data,
+                           offset=offset, strides=(stride, 3, 1))
+        # Mapped for reading only, upstream still owns the memory.
+        frame.flags.writeable = False
+        yield frame
+    finally:
+        _libgst.gst_buffer_unmap(ptr, mapinfo)
+
+def _make_svg_pusher(overlay, overlaysink):
+    """Returns a function setting an SVG on whichever overlay elements exist."""
+    setters = [functools.partial(element.set_property, name)
+               for element, name in ((overlay, 'data'), (overlaysink, 'svg')) if element]
+    def push_svg(svg):
+        for setter in setters:
+            setter(svg)
+    return push_svg
+
+def _attr(value):
+    return quoteattr(str(value))
+
+class SvgBuilder:
+    """Builds the SVG overlay returned by user_function.
+
+    Elements are formatted straight into strings and joined once, which is
+    much cheaper per frame than building and serializing an svgwrite.Drawing.
+    Attribute values are quoted and escaped like svgwrite does.
+    """
+    def __init__(self, size):
+        width, height = size
+        self.parts = ['<svg xmlns="http://www.w3.org/2000/svg" width=%s height=%s>'
+                      % (_attr(width), _attr(height))]
+
+    def add_rect(self, x, y, w, h, color, stroke_width=2):
+        self.parts.append('<rect x=%s y=%s width=%s height=%s fill="none" '
+                          'stroke=%s stroke-width=%s/>'
+                          % (_attr(x), _attr(y), _attr(w), _attr(h), _attr(color),
+                             _attr(stroke_width)))
+
+    def add_text(self, x, y, text, color, font_size=20):
+        self.parts.append('<text x=%s y=%s fill=%s font-size=%s>%s</text>'
+                          % (_attr(x), _attr(y), _attr(color), _attr(font_size),
+                             escape(text)))
+
+    def finish(self):
+        # Doesn't modify the builder, so it can be called more than once.
+        return ''.join(self.parts) + '</svg>'
+
 class GstPipeline:
-    def __init__(self, pipeline, user_function, src_size):
+    def __init__(self, pipeline, user_function, src_size, inference_core=None,
+                 batch=1):
+        if batch < 1:
+            raise ValueError('batch must be at least 1, got %r' % (batch,))
         self.user_function = user_function
-        self.running = False
-        self.gstbuffer = None
+        self.inference_core = inference_core
+        self.batch = batch
         self.sink_size = None
         self.src_size = src_size
         self.box = None
-        self.condition = threading.Condition()
+        self.frame_buf = None
+        self.frame_view = None
+        self.caps_ready = threading.Event()
+        self._gl_context_set = False
 
         self.pipeline = Gst.parse_launch(pipeline)
         self.overlay = self.pipeline.get_by_name('overlay')
         self.overlaysink = self.pipeline.get_by_name('overlaysink')
-        appsink = self.pipeline.get_by_name('appsink')
-        appsink.connect('new-sample', self.on_new_sample)
+        self.push_svg = _make_svg_pusher(self.overlay, self.overlaysink)
+        # The appsink is drained directly by the inference worker, its queue
+        # (one buffer unless batching) is the only frame handoff. Old frames are
+        # dropped so the streaming thread never waits on a slow inference.
+        self.appsink = self.pipeline.get_by_name('appsink')
+        self.appsink.set_property('emit-signals', False)
+        self.appsink.set_property('max-buffers', batch)
+        self.appsink.set_property('drop', True)
+        if self.appsink.find_property('leaky-type'):
+            self.appsink.set_property('leaky-type', GstApp.AppLeakyType.DOWNSTREAM)
+        self.appsink.get_static_pad('sink').connect('notify::caps', self.on_sink_caps)
 
         # Set up a pipeline bus watch to catch errors.
         bus = self.pipeline.get_bus()
@@ -51,7 +187,6 @@ class GstPipeline:
 
     def run(self):
         # Start inference worker.
-        self.running = True
         worker = threading.Thread(target=self.inference_loop)
         worker.start()
 
@@ -62,13 +197,15 @@ class GstPipeline:
         except:
             pass
 
-        # Clean up.
+        # Clean up. Stopping the pipeline unblocks the worker's pull.
+        self.caps_ready.set()
         self.pipeline.set_state(Gst.State.NULL)
-        while GLib.MainContext.default().iteration(False):
-            pass
-        with self.condition:
-            self.running = False
-            self.condition.notify_all()
+        self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
+        # Flush pending bus signals without spinning on a busy context.
+        context = GLib.MainContext.default()
+        for _ in range(100):
+            if not context.iteration(False):
+                break
         worker.join()
 
     def on_bus_message(self, bus, message):
@@ -84,55 +221,105 @@ class GstPipeline:
             Gtk.main_quit()
         return True
 
-    def on_new_sample(self, sink):
-        sample = sink.emit('pull-sample')
-        if not self.sink_size:
-            s = sample.get_caps().get_structure(0)
+    def on_sink_caps(self, pad, pspec):
+        caps = pad.get_current_caps()
+        if caps:
+            s = caps.get_structure(0)
             self.sink_size = (s.get_value('width'), s.get_value('height'))
-        with self.condition:
-            self.gstbuffer = sample.get_buffer()
-            self.condition.notify_all()
-        return Gst.FlowReturn.OK
+            self.box = self.get_box()
+            # Scratch frames for buffers whose rows are padded.
+            self.frame_buf = np.empty((self.batch, self.sink_size[1], self.sink_size[0], 3),
+                                      np.uint8)
+            # user_function gets the same read-only view as for mapped buffers.
+            self.frame_view = self.frame_buf.view()
+            self.frame_view.flags.writeable = False
+            self.caps_ready.set()
 
     def get_box(self):
-        if not self.box:
-            glbox = self.pipeline.get_by_name('glbox')
-            if glbox:
-                glbox = glbox.get_by_name('filter')
-            box = self.pipeline.get_by_name('box')
-            assert glbox or box
-            assert self.sink_size
-            if glbox:
-                self.box = (glbox.get_property('x'), glbox.get_property('y'),
-                        glbox.get_property('width'), glbox.get_property('height'))
-            else:
-                self.box = (-box.get_property('left'), -box.get_property('top'),
-                    self.sink_size[0] + box.get_property('left') + box.get_property('right'),
-                    self.sink_size[1] + box.get_property('top') + box.get_property('bottom'))
-        return self.box
+        glbox = self.pipeline.get_by_name('glbox')
+        if glbox:
+            glbox = glbox.get_by_name('filter')
+        box = self.pipeline.get_by_name('box')
+        assert glbox or box
+        assert self.sink_size
+        if glbox:
+            return (glbox.get_property('x'), glbox.get_property('y'),
+                    glbox.get_property('width'), glbox.get_property('height'))
+        return (-box.get_property('left'), -box.get_property('top'),
+            self.sink_size[0] + box.get_property('left') + box.get_property('right'),
+            self.sink_size[1] + box.get_property('top') + box.get_property('bottom'))
 
     def inference_loop(self):
+        # Keep the worker on one core so the model's working set stays in its
+        # caches. On Linux pid 0 is the calling thread, not the whole process.
+        if self.inference_core is not None and hasattr(os, 'sched_setaffinity'):
+            if self.inference_core in os.sched_getaffinity(0):
+                os.sched_setaffinity(0, {self.inference_core})
+
+        # Sink size and box are fixed once the appsink caps are negotiated.
+        self.caps_ready.wait()
+        if self.frame_buf is None:
+            return  # Shut down before caps were negotiated.
+        if self.batch > 1:
+            self.batch_inference_loop()
+            return
+
+        sink_size, box = self.sink_size, self.box
+        frame_buf, frame_view = self.frame_buf[0], self.frame_view[0]
+        push_svg = self.push_svg
+        last_svg = None
+        while True:
+            # Blocks with the GIL released, returns None on EOS or shutdown.
+            sample = self.appsink.pull_sample()
+            if not sample:
+                break
+
+            # Passing a numpy view of the mapped buffer avoids copying the frame,
+            # unless padded rows have to be packed into a contiguous tensor.
+            # The sample keeps the buffer alive, no separate reference is held.
+            with gst_buffer_map_np(sample.get_buffer(), sink_size) as input_tensor:
+                if not input_tensor.flags.c_contiguous:
+                    np.copyto(frame_buf, input_tensor)
+                    input_tensor = frame_view
+                svg = self.user_function(input_tensor, self.src_size, box)
+            # Release the frame now rather than while waiting for the next one.
+            del sample, input_tensor
+            # Unchanged overlays are common, don't make the sink reparse them.
+            if svg and svg != last_svg:
+                last_svg = svg
+                push_svg(svg)
+
+    def batch_inference_loop(self):
+        sink_size, box = self.sink_size, self.box
+        frame_bufs, frame_views = self.frame_buf, self.frame_view
+        push_svg = self.push_svg
+        last_svg = None
         while True:
-            with self.condition:
-                while not self.gstbuffer and self.running:
-                    self.condition.wait()
-                if not self.running:
+            sample = self.appsink.pull_sample()
+            if not sample:
+                break
+            # Add frames that are already queued or arrive shortly after.
+            samples = [sample]
+            while len(samples) < self.batch:
+                sample = self.appsink.try_pull_sample(BATCH_TIMEOUT)
+                if not sample:
                     break
-                gstbuffer = self.gstbuffer
-                self.gstbuffer = None
-
-            # Passing Gst.Buffer as input tensor avoids 2 copies of it:
-            # * Python bindings copies the data when mapping gstbuffer
-            # * Numpy copies the data when creating ndarray.
-            # This requires a recent version of the python3-edgetpu package. If this
-            # raises an exception please make sure dependencies are up to date.
-            input_tensor = gstbuffer
-            svg = self.user_function(input_tensor, self.src_size, self.get_box())
-            if svg:
-                if self.overlay:
-                    self.overlay.set_property('data', svg)
-                if self.overlaysink:
-                    self.overlaysink.set_property('svg', svg)
+                samples.append(sample)
+
+            with contextlib.ExitStack() as stack:
+                input_tensors = []
+                for sample, frame_buf, frame_view in zip(samples, frame_bufs, frame_views):
+                    input_tensor = stack.enter_context(
+                        gst_buffer_map_np(sample.get_buffer(), sink_size))
+                    if not input_tensor.flags.c_contiguous:
+                        np.copyto(frame_buf, input_tensor)
+                        input_tensor = frame_view
+                    input_tensors.append(input_tensor)
+                svg = self.user_function(input_tensors, self.src_size, box)
+            del samples, sample, input_tensors, input_tensor
+            if svg and svg != last_svg:
+                last_svg = svg
+                push_svg(svg)
 
     def setup_window(self):
         # Only set up our own window if we have Coral overlay sink in the pipeline.
@@ -140,8 +327,7 @@ class GstPipeline:
             return
 
         gi.require_version('GstGL', '1.0')
-        gi.require_version('GstVideo', '1.0')
-        from gi.repository import GstGL, GstVideo
+        from gi.repository import GstGL
 
         # Needed to commit the wayland sub-surface.
         def on_gl_draw(sink, widget):
@@ -179,6 +365,9 @@ class GstPipeline:
         # rendering so they get the same GL context. This isn't automatically handled
         # by GStreamer as we're the ones setting an external display handle.
         def on_bus_message_sync(bus, message, overlaysink):
+            # Messages already in flight on other threads can still arrive here.
+            if self._gl_context_set:
+                return Gst.BusSyncReply.PASS
             if message.type == Gst.MessageType.NEED_CONTEXT:
                 _, context_type = message.parse_context_type()
                 if context_type == GstGL.GL_DISPLAY_CONTEXT_TYPE:
@@ -188,55 +377,54 @@ class GstPipeline:
                         display_context = Gst.Context.new(GstGL.GL_DISPLAY_CONTEXT_TYPE, True)
                         GstGL.context_set_gl_display(display_context, gl_context.get_display())
                         message.src.set_context(display_context)
+                        # The pipeline keeps the context and answers later requests
+                        # for it, so stop paying for a Python call per message.
+                        self.pipeline.set_context(display_context)
+                        self._gl_context_set = True
+                        bus.set_sync_handler(None)
             return Gst.BusSyncReply.PASS
 
         bus = self.pipeline.get_bus()
         bus.set_sync_handler(on_bus_message_sync, self.overlaysink)
 
+@functools.lru_cache(maxsize=None)
 def detectCoralDevBoard():
   try:
-    if 'MX8MQ' in open('/sys/firmware/devicetree/base/model').read():
+    with open('/sys/firmware/devicetree/base/model', 'rb') as f:
+      data = f.read()
+    if b'MX8MQ' in data:
       print('Detected Edge TPU dev board.')
       return True
   except: pass
   return False
 
-def run_pipeline(user_function, appsink_size):
-    # For default camera (Coral Camera w/ Dev Board):
-    PIPELINE = 'v4l2src device=/dev/video0 ! {src_caps}'
-    # For alternative camera (USB camera w/ Dev Board):
-    #PIPELINE = 'v4l2src device=/dev/video1 ! {src_caps}'
-    SRC_CAPS = 'video/x-raw,width={width},height={height},framerate=30/1'
+def run_pipeline(user_function, appsink_size, inference_core=3, batch=1):
+    """Runs the camera pipeline, calling user_function for every frame.
+
+    user_function(input_tensor, src_size, inference_box) gets the frame as a
+    (height, width, 3) uint8 array and returns an SVG overlay string or None.
+    The array is read-only and only valid during the call, it either maps the
+    camera buffer or reuses a scratch frame, so copy it if it must be kept.
+    Passing batch > 1 opts in to batching: the first argument is then a list
+    of up to batch such arrays, so user_function must be written for that.
+    """
     if detectCoralDevBoard():
         scale_caps = None
         src_size = (1920, 1080)
-        PIPELINE += """ ! glupload ! tee name=t
-            t. ! queue ! glfilterbin filter=glbox name=glbox ! {sink_caps} ! {sink_element}
-            t. ! queue ! glsvgoverlaysink name=overlaysink
-        """
+        pipeline = PIPELINE_CORAL
     else:
         src_size = (640, 480)
         scale = min(appsink_size[0] / src_size[0], appsink_size[1] / src_size[1])
         scale = tuple(int(x * scale) for x in src_size)
         scale_caps = 'video/x-raw,width={width},height={height}'.format(width=scale[0], height=scale[1])
-        PIPELINE += """ ! tee name=t
-            t. ! {leaky_q} ! videoconvert ! videoscale ! {scale_caps} ! videobox name=box autocrop=true
-               ! {sink_caps} ! {sink_element}
-            t. ! {leaky_q} ! videoconvert
-               ! rsvgoverlay name=overlay ! videoconvert ! ximagesink sync=false
-            """
-
-    SINK_ELEMENT = 'appsink name=appsink emit-signals=true max-buffers=1 drop=true'
-    SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
-    LEAKY_Q = 'queue max-size-buffers=1 leaky=downstream'
+        pipeline = PIPELINE_DESKTOP
 
     src_caps = SRC_CAPS.format(width=src_size[0], height=src_size[1])
     sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
-    pipeline = PIPELINE.format(leaky_q=LEAKY_Q,
-        src_caps=src_caps, sink_caps=sink_caps,
-        sink_element=SINK_ELEMENT, scale_caps=scale_caps)
+    pipeline = pipeline.format(src_caps=src_caps, sink_caps=sink_caps,
+        scale_caps=scale_caps)
 
     print('Gstreamer pipeline:\n', pipeline)
 
-    pipeline = GstPipeline(pipeline, user_function, src_size)
+    pipeline = GstPipeline(pipeline, user_function, src_size, inference_core, batch)
     pipeline.run()